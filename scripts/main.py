@@ -4,6 +4,8 @@ import sqlite3
 import shlex
 import json
 import itertools
+import threading
+import calendar
 from peewee import *
 import datetime
 from playhouse.shortcuts import model_to_dict
@@ -25,6 +27,7 @@ RESET_TEXT_COLOUR = '\033[39m'
 CATEGORIES = ['project', 'recurring', 'manual', 'todo', 'task', 'note', 'folder']
 STATUS_OPTIONS = ['open', 'closed', 'deprecated', 'deleted']
 DEFAULT_TAGS = []
+RECURRENCE_UNITS = ['daily', 'weekly', 'monthly', 'yearly']
 
 # Path to the directory containing this script
 SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -58,6 +61,15 @@ class NodeTags(BaseModel):
     tag = TextField()
 
 
+class Recurrences(BaseModel):
+    node = ForeignKeyField(Nodes, backref='recurrence', unique=True, on_delete='CASCADE')
+    unit = TextField()
+    interval = IntegerField(default=1)
+    anchor = DateTimeField() # first occurrence, every later one is computed from it so month ends dont drift
+    occurrences = IntegerField(default=0) # how many have been materialised so far
+    next_due = DateTimeField(index=True) # due scans only touch rows at the front of this index
+
+
 db.connect()
 
 
@@ -80,7 +92,7 @@ class Virtual_Manager(cmd.Cmd):
         '''initialises the empty database if it doesnt exist'''
         
         try:
-            db.create_tables([Nodes, NodeTags])
+            db.create_tables([Nodes, NodeTags, Recurrences])
             print('db init success')
         except Exception as e:
             print('failed: ', e)
@@ -89,6 +101,7 @@ class Virtual_Manager(cmd.Cmd):
         '''deletes the database if it exists'''
         if os.path.exists(DB_PATH):
             if input('DELETE THE DATABASE? (y/n): ').lower() == 'y':
+                stop_ticker() # otherwise its next run would recreate an empty vm.db
                 db.close()
                 os.remove(DB_PATH)
                 print('success')
@@ -337,6 +350,8 @@ class Virtual_Manager(cmd.Cmd):
             return
         
         if hard:
+            if 'recurrences' in db.get_tables(): # sqlite doesnt enforce the cascade without the foreign_keys pragma
+                Recurrences.delete().where(Recurrences.node == id).execute()
             count = Nodes.delete().where(Nodes.id == id).execute()
         else:
             count = Nodes.update({Nodes.status: 'deleted'}).where(Nodes.id == id).execute() #simply marks it as such
@@ -529,6 +544,127 @@ class Virtual_Manager(cmd.Cmd):
         else:
             print('Node not found')
 
+    def do_recur(self, arg):
+        '''sets the recurrence rule of a recurring node
+        format: recur <id> <unit> <interval(optional)> <start(optional)>
+        units: daily, weekly, monthly, yearly. start is YYYY-MM-DD and defaults to now
+        example: recur 7 monthly 1 2025-07-01
+        use recur <id> off to remove the rule'''
+
+        if not recurrence_existence():
+            return
+
+        args = shlex.split(arg)
+        try:
+            id = int(args[0])
+            unit = args[1].lower()
+            if unit != 'off' and unit not in RECURRENCE_UNITS:
+                raise Exception('unit must be one of: ' + ', '.join(RECURRENCE_UNITS))
+            interval = int(args[2]) if len(args) > 2 else 1
+            if interval < 1:
+                raise Exception('interval must be at least 1')
+            if len(args) > 3:
+                anchor = datetime.datetime.strptime(args[3], '%Y-%m-%d')
+            else:
+                anchor = datetime.datetime.now().replace(microsecond=0)
+        except Exception as e:
+            print('invalid format. format: recur <id> <unit> <interval(optional)> <start(optional)>', e)
+            return
+
+        if unit == 'off':
+            if Recurrences.delete().where(Recurrences.node == id).execute():
+                print('success')
+            else:
+                print('node has no recurrence rule')
+            return
+
+        node = Nodes.get_or_none(Nodes.id == id)
+        if not node:
+            print('node does not exist')
+            return
+        if node.category != 'recurring':
+            print('only recurring nodes can have a recurrence rule')
+            return
+
+        Recurrences.insert(
+            node = id,
+            unit = unit,
+            interval = interval,
+            anchor = anchor,
+            occurrences = 0,
+            next_due = anchor
+        ).on_conflict_replace().execute()
+        print(f'success. next due: {anchor}')
+
+    def do_due(self, arg):
+        '''creates a task under each recurring node that is due
+        if several occurrences were missed only the latest one gets a task, the rest are counted as skipped
+        closed, deprecated and deleted routines are skipped'''
+
+        if not recurrence_existence():
+            return
+
+        try:
+            created, skipped = materialise_due()
+        except Exception as e:
+            print('failed: ', e)
+            return
+        print(f'{created} task(s) created, {skipped} missed occurrence(s) skipped')
+
+    def do_upcoming(self, arg):
+        '''lists the next open recurring nodes to come due
+        format: upcoming <count(optional)>'''
+
+        if not recurrence_existence():
+            return
+
+        try:
+            count = int(arg) if arg else 10
+        except ValueError:
+            print('invalid format. format: upcoming <count(optional)>')
+            return
+
+        query = (Recurrences
+                 .select(Recurrences, Nodes)
+                 .join(Nodes)
+                 .where((Nodes.category == 'recurring') & (Nodes.status.is_null() | (Nodes.status == 'open'))) # same routines due acts on
+                 .order_by(Recurrences.next_due)
+                 .limit(count))
+
+        if not query:
+            print('no recurrence rules found.')
+            return
+
+        for rec in query:
+            print(f'{rec.next_due}  {rec.node.id}-recurring: {rec.node.title}  (every {rec.interval} {rec.unit})')
+
+    def do_tick(self, arg):
+        '''runs due in the background every few minutes
+        format: tick <minutes>
+        use tick off to stop it'''
+
+        global ticker
+
+        if not recurrence_existence():
+            return
+
+        stop_ticker()
+        if arg.strip().lower() == 'off':
+            print('ticker stopped')
+            return
+
+        try:
+            minutes = float(arg)
+            if minutes <= 0:
+                raise ValueError
+        except ValueError:
+            print('invalid format. format: tick <minutes> or tick off')
+            return
+
+        ticker = threading.Event()
+        threading.Thread(target=tick_loop, args=(ticker, minutes * 60), daemon=True).start()
+        print(f'ticker started, running every {minutes} minute(s)')
+
 def db_existence():
     if 'nodes' in db.get_tables() and 'nodetags' in db.get_tables():
         return True
@@ -536,6 +672,119 @@ def db_existence():
     return False
 
 
+def recurrence_existence():
+    if not db_existence():
+        return False
+    if 'recurrences' in db.get_tables():
+        return True
+    print('recurrence table not found. run init_db to create it.')
+    return False
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1]) # 31st becomes last day of shorter months
+    return date.replace(year=year, month=month, day=day)
+
+
+def nth_occurrence(anchor, unit, interval, n):
+    steps = interval * n
+    match unit:
+        case 'daily':
+            return anchor + datetime.timedelta(days=steps)
+        case 'weekly':
+            return anchor + datetime.timedelta(weeks=steps)
+        case 'monthly':
+            return add_months(anchor, steps)
+        case 'yearly':
+            return add_months(anchor, steps * 12)
+    raise ValueError(f'unknown recurrence unit: {unit}')
+
+
+def latest_occurrence(rec, now):
+    '''index of the last occurrence at or before now, found without walking every missed one'''
+
+    match rec.unit:
+        case 'daily' | 'weekly':
+            step = datetime.timedelta(days=rec.interval * (7 if rec.unit == 'weekly' else 1))
+            n = (now - rec.anchor) // step
+        case _:
+            months = (now.year - rec.anchor.year) * 12 + now.month - rec.anchor.month
+            n = months // (rec.interval * (12 if rec.unit == 'yearly' else 1))
+    n = max(n, rec.occurrences)
+    while nth_occurrence(rec.anchor, rec.unit, rec.interval, n + 1) <= now: # estimate can be off by one either way
+        n += 1
+    while n > rec.occurrences and nth_occurrence(rec.anchor, rec.unit, rec.interval, n) > now:
+        n -= 1
+    return n
+
+
+def materialise_due(now=None):
+    '''inserts a task for the latest due occurrence of each routine and moves next_due past now, all in one transaction.
+    older missed occurrences are skipped rather than flooding the tree, returns (created, skipped).
+    only rows with next_due <= now are read, so the cost follows the number due rather than the table size'''
+
+    now = now or datetime.datetime.now()
+    stamp = now.isoformat()
+
+    with db.atomic('IMMEDIATE'): # takes the write lock before reading so an overlapping tick waits instead of failing
+        due = (Recurrences
+               .select(Recurrences, Nodes)
+               .join(Nodes)
+               .where((Recurrences.next_due <= now) & (Nodes.category == 'recurring')))
+
+        new_tasks = []
+        advanced = []
+        skipped = 0
+        for rec in due:
+            latest = latest_occurrence(rec, now) # only the most recent missed occurrence becomes a task
+            skipped += latest - rec.occurrences
+            if rec.node.status in [None, 'open']:
+                new_tasks.append({
+                    'title': f'{rec.node.title} {nth_occurrence(rec.anchor, rec.unit, rec.interval, latest):%Y-%m-%d}',
+                    'category': 'task',
+                    'parent': rec.node.id,
+                    'status': 'open',
+                    'created_at': stamp,
+                    'last_updated': stamp,
+                    'content': rec.node.content})
+            else:
+                skipped += 1
+            advanced.append((rec.id, latest + 1, nth_occurrence(rec.anchor, rec.unit, rec.interval, latest + 1)))
+
+        for batch in chunked(new_tasks, 100): # stays under sqlite's bound variable limit
+            Nodes.insert_many(batch).execute()
+
+        for id, occurrences, next_due in advanced:
+            Recurrences.update(occurrences=occurrences, next_due=next_due).where(Recurrences.id == id).execute()
+
+    return len(new_tasks), skipped
+
+
+ticker = None # threading.Event of the running background tick, set it to stop the loop
+
+
+def stop_ticker():
+    global ticker
+    if ticker:
+        ticker.set()
+        ticker = None
+
+
+def tick_loop(stop, seconds):
+    while not stop.wait(seconds):
+        try:
+            created, skipped = materialise_due()
+            if created or skipped:
+                print(f'\n[tick] {created} recurring task(s) created, {skipped} missed occurrence(s) skipped')
+        except Exception as e:
+            print('\n[tick] failed: ', e)
+        finally:
+            db.close() # each thread gets its own connection, dont leave this one open
+
+
 def show_tree(root_id):
     query = Nodes.select(
         Nodes.id,